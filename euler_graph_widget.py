@@ -1,5 +1,6 @@
-from collections import Counter
+from collections import Counter, deque
 from math import atan, cos, sin, degrees, sqrt, radians, pi
+from sys import getsizeof
 
 from PyQt5 import QtCore, QtGui, QtWidgets
 from PyQt5.QtCore import Qt
@@ -133,13 +134,236 @@ def get_angle(x, y):
     return angle
 
 
-def num_edges(start_node, end_node, graph):
-    result = 0
-    for node1, node2 in graph.edges():
-        if node1 == start_node and node2 == end_node:
-            result += 1
+def approximate_size(obj):
+    """Estimate the memory used by an object, including the contents of any lists, tuples, sets or dicts it holds"""
+    size = getsizeof(obj)
 
-    return result
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            size += approximate_size(key) + approximate_size(value)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for item in obj:
+            size += approximate_size(item)
+
+    return size
+
+
+class NodeMove:
+    """Undo log entry for moved nodes
+
+    The change is stored as a position offset for each node rather than as the positions themselves, so consecutive
+    moves of the same nodes can be merged by adding the offsets together.
+    """
+
+    # estimated bytes for a node id and its two offsets (small ints)
+    element_size = 3 * getsizeof(0)
+
+    def __init__(self, nodes, dx, dy):
+        self.nodes = tuple(nodes)
+        self.dx = list(dx)
+        self.dy = list(dy)
+
+    def size(self):
+        # estimated from the number of nodes rather than by walking the lists, because the size is recalculated
+        # every time a mouse move event is merged into the entry
+        containers = getsizeof(self.nodes) + getsizeof(self.dx) + getsizeof(self.dy)
+        return containers + len(self.nodes) * self.element_size
+
+    def merge(self, other):
+        if not isinstance(other, NodeMove) or other.nodes != self.nodes:
+            return False
+
+        for i in range(len(self.nodes)):
+            self.dx[i] += other.dx[i]
+            self.dy[i] += other.dy[i]
+
+        return True
+
+    def undo(self, graph_widget):
+        self._shift(graph_widget, -1)
+
+    def redo(self, graph_widget):
+        self._shift(graph_widget, 1)
+
+    def _shift(self, graph_widget, sign):
+        nodes = graph_widget.graph.nodes
+        for node, dx, dy in zip(self.nodes, self.dx, self.dy):
+            if node in nodes:
+                nodes[node]["x"] += sign * dx
+                nodes[node]["y"] += sign * dy
+
+
+class GraphChange:
+    """Undo log entry for nodes and edges that have been added to or removed from the graph
+
+    Nodes are stored as (node, attributes) pairs and edges as (edge, attributes, weight text) triples. The widgets are
+    left out of the attributes, because they are recreated whenever a node or edge is restored.
+
+    In a multigraph, removed_edge_orders holds ((start node, end node), keys) pairs giving the order of the parallel
+    edges before the removal. paintEvent curves parallel edges according to this order, so it is put back on undo.
+    Restored nodes still go at the end of the graph's node order.
+    """
+
+    def __init__(self, added_nodes=(), added_edges=(), removed_nodes=(), removed_edges=(), removed_edge_orders=()):
+        self.added_nodes = tuple(added_nodes)
+        self.added_edges = tuple(added_edges)
+        self.removed_nodes = tuple(removed_nodes)
+        self.removed_edges = tuple(removed_edges)
+        self.removed_edge_orders = tuple(removed_edge_orders)
+
+    def size(self):
+        return approximate_size((self.added_nodes, self.added_edges, self.removed_nodes, self.removed_edges,
+                                 self.removed_edge_orders))
+
+    def merge(self, other):
+        return False
+
+    def undo(self, graph_widget):
+        self._apply(graph_widget, self.added_nodes, self.added_edges, self.removed_nodes, self.removed_edges)
+
+        for (start_node, end_node), keys in self.removed_edge_orders:
+            graph_widget._reorder_parallel_edges(start_node, end_node, keys)
+
+    def redo(self, graph_widget):
+        self._apply(graph_widget, self.removed_nodes, self.removed_edges, self.added_nodes, self.added_edges)
+
+    @staticmethod
+    def _apply(graph_widget, delete_nodes, delete_edges, restore_nodes, restore_edges):
+        # edges are removed before their nodes and restored after them
+        for edge, *_ in delete_edges:
+            graph_widget._delete_edge(edge)
+
+        for node, _ in delete_nodes:
+            graph_widget._delete_node(node)
+
+        for node, attributes in restore_nodes:
+            graph_widget._restore_node(node, attributes)
+
+        for edge, attributes, text in restore_edges:
+            graph_widget._restore_edge(edge, attributes, text)
+
+
+class Recolour:
+    """Undo log entry for nodes or edges that have been given a new colour
+
+    :param view: The graph attribute holding the items, either "nodes" or "edges"
+    :type view: str
+    """
+
+    def __init__(self, view, items, old_colors, new_color):
+        self.view = view
+        self.items = tuple(items)
+        self.old_colors = tuple(old_colors)
+        self.new_color = new_color
+
+    def size(self):
+        return approximate_size((self.items, self.old_colors)) + getsizeof(self.new_color)
+
+    def merge(self, other):
+        return False
+
+    def undo(self, graph_widget):
+        attributes = getattr(graph_widget.graph, self.view)
+        for item, color in zip(self.items, self.old_colors):
+            if item in attributes:
+                attributes[item]["color"] = color
+
+    def redo(self, graph_widget):
+        attributes = getattr(graph_widget.graph, self.view)
+        for item in self.items:
+            if item in attributes:
+                attributes[item]["color"] = self.new_color
+
+
+class UndoLog:
+    """Undo and redo stacks of graph changes, with a cap on the memory they use
+
+    When the estimated memory used by both stacks goes over the limit, the oldest undo entries are evicted. The newest
+    entry is always kept, so the last change can be undone even if it is bigger than the limit on its own.
+
+    :param memory_limit: The maximum number of bytes used by the log, or None for no limit
+    :type memory_limit: int
+    """
+
+    def __init__(self, memory_limit=None):
+        self.memory_limit = memory_limit
+        self.memory_used = 0
+
+        # entries are stored as (change, size) pairs
+        self.undo_stack = deque()
+        self.redo_stack = []
+
+        # whether the next mergeable change can be merged into the top of the undo stack
+        self.mergeable = False
+
+    def push(self, change, merge=False):
+        """Record a change that has already been applied to the graph
+
+        :param change: The change to record
+        :param merge: Merge the change into the previous one if that was also pushed with merge=True, and the log hasn't
+            been sealed since
+        :type merge: bool
+        """
+        for _, size in self.redo_stack:
+            self.memory_used -= size
+        self.redo_stack.clear()
+
+        if merge and self.mergeable and self.undo_stack:
+            top, size = self.undo_stack[-1]
+            if top.merge(change):
+                new_size = top.size()
+                self.undo_stack[-1] = (top, new_size)
+                self.memory_used += new_size - size
+                self._evict()
+                return
+
+        size = change.size()
+        self.undo_stack.append((change, size))
+        self.memory_used += size
+        self.mergeable = merge
+
+        self._evict()
+
+    def seal(self):
+        """Stop the next change being merged into the previous one"""
+        self.mergeable = False
+
+    def undo(self):
+        """Move the newest change to the redo stack and return it, or return None if there is nothing to undo"""
+        self.seal()
+
+        if not self.undo_stack:
+            return None
+
+        entry = self.undo_stack.pop()
+        self.redo_stack.append(entry)
+        return entry[0]
+
+    def redo(self):
+        """Move the newest undone change back to the undo stack and return it, or return None if there is nothing to
+        redo"""
+        self.seal()
+
+        if not self.redo_stack:
+            return None
+
+        entry = self.redo_stack.pop()
+        self.undo_stack.append(entry)
+        return entry[0]
+
+    def clear(self):
+        self.undo_stack.clear()
+        self.redo_stack.clear()
+        self.memory_used = 0
+        self.mergeable = False
+
+    def _evict(self):
+        if self.memory_limit is None:
+            return
+
+        while self.memory_used > self.memory_limit and len(self.undo_stack) > 1:
+            _, size = self.undo_stack.popleft()
+            self.memory_used -= size
 
 
 class EulerGraphWidget(QtWidgets.QWidget):
@@ -191,6 +415,12 @@ class EulerGraphWidget(QtWidgets.QWidget):
         def get_weight(self):
             return float(self.line_edit.text())
 
+        def get_text(self):
+            return self.line_edit.text()
+
+        def set_text(self, text):
+            self.line_edit.setText(text)
+
     class BaseWidgetOnNode(QtWidgets.QWidget):
         def __init__(self, *args, **kwargs):
             super(EulerGraphWidget.BaseWidgetOnNode, self).__init__(*args, **kwargs)
@@ -203,7 +433,7 @@ class EulerGraphWidget(QtWidgets.QWidget):
 
     def __init__(self, graph, *args, default_node_size=20, default_node_color=Qt.black, hover_colour=Qt.blue,
                  select_colour=Qt.red, zoom_rate=0.01, loop_width=20, loop_height=30, multi_edge_spacing=20,
-                 direction_triangle_size=15, default_edge_color=Qt.black, **kwargs):
+                 direction_triangle_size=15, default_edge_color=Qt.black, undo_memory_limit=2 ** 24, **kwargs):
         super(EulerGraphWidget, self).__init__(*args, **kwargs)
 
         self.default_node_size = default_node_size
@@ -252,7 +482,12 @@ class EulerGraphWidget(QtWidgets.QWidget):
         self.drawing_edge = False
         self.edge_start_node = None
 
+        # changes to the graph, stored as deltas so they can be undone and redone
+        self.undo_log = UndoLog(undo_memory_limit)
+
     def mousePressEvent(self, event):
+        self.undo_log.seal()
+
         if event.button() == Qt.RightButton and event.modifiers() == Qt.ShiftModifier:
             self.createNode(event.x(), event.y())
         elif event.button() == Qt.LeftButton:
@@ -276,6 +511,9 @@ class EulerGraphWidget(QtWidgets.QWidget):
         self.update()
 
     def mouseReleaseEvent(self, event):
+        # a drag has finished, so the next drag gets its own undo entry
+        self.undo_log.seal()
+
         if event.button() == Qt.LeftButton:
             self.moving_nodes = False
 
@@ -313,21 +551,32 @@ class EulerGraphWidget(QtWidgets.QWidget):
         # If this event is triggered, the mouse isn't over a child widget, so it cannot be hovering over an edge.
         self.hovered_edge = None
 
-        # panning and moving selected nodes
-        if self.panning:
-            for node, data in self.graph.nodes().data():
-                data["x"] += self.mouse_x - last_mouse_x
-                data["y"] += self.mouse_y - last_mouse_y
-        elif self.moving_nodes:
-            for node in self.selected_nodes:
-                self.graph.nodes[node]["x"] += self.mouse_x - last_mouse_x
-                self.graph.nodes[node]["y"] += self.mouse_y - last_mouse_y
+        # panning and moving selected nodes (every move event in a drag is merged into one undo entry)
+        if self.panning or self.moving_nodes:
+            dx = self.mouse_x - last_mouse_x
+            dy = self.mouse_y - last_mouse_y
+
+            if self.panning:
+                nodes = list(self.graph.nodes)
+            else:
+                nodes = list(self.selected_nodes)
+
+            for node in nodes:
+                self.graph.nodes[node]["x"] += dx
+                self.graph.nodes[node]["y"] += dy
+
+            if nodes and (dx != 0 or dy != 0):
+                self.undo_log.push(NodeMove(nodes, [dx] * len(nodes), [dy] * len(nodes)), merge=True)
 
         self.update()
 
     def keyPressEvent(self, event):
         if event.key() == Qt.Key_Delete:
             self.deleteSelection()
+        elif event.matches(QtGui.QKeySequence.Undo):
+            self.undo()
+        elif event.matches(QtGui.QKeySequence.Redo):
+            self.redo()
 
     def wheelEvent(self, event):
         # zoom
@@ -342,9 +591,21 @@ class EulerGraphWidget(QtWidgets.QWidget):
                 scale_factor = -1 / (event.angleDelta().y() * self.zoom_rate)
 
             # multiply all positions by the scale factor
+            nodes, dx, dy = [], [], []
             for node, data in self.graph.nodes().data():
-                data["x"] = int((data["x"] - self.mouse_x) * scale_factor + self.mouse_x)
-                data["y"] = int((data["y"] - self.mouse_y) * scale_factor + self.mouse_y)
+                x = int((data["x"] - self.mouse_x) * scale_factor + self.mouse_x)
+                y = int((data["y"] - self.mouse_y) * scale_factor + self.mouse_y)
+
+                nodes.append(node)
+                dx.append(x - data["x"])
+                dy.append(y - data["y"])
+
+                data["x"] = x
+                data["y"] = y
+
+            # zooming an empty graph, or zooming by too little to move any node, doesn't need an undo entry
+            if any(dx) or any(dy):
+                self.undo_log.push(NodeMove(nodes, dx, dy))
 
             self.update()
 
@@ -515,6 +776,7 @@ class EulerGraphWidget(QtWidgets.QWidget):
         widget.show()
 
         self.graph.add_node(self.next_node_id, x=x, y=y, size=size, color=color, widget=widget)
+        self.undo_log.push(GraphChange(added_nodes=[self._node_record(self.next_node_id)]))
 
         self.hovered_node = self.next_node_id
         self.next_node_id += 1
@@ -524,19 +786,24 @@ class EulerGraphWidget(QtWidgets.QWidget):
             color = self.default_edge_color
 
         if self.multi_edge:
-            edge_num = num_edges(start_node, end_node, self.graph)
-            if not self.directed:
-                edge_num += num_edges(end_node, start_node, self.graph)
-
-            edge = start_node, end_node, edge_num
+            # use the key the graph would assign, so the widget, the selection and the undo log all agree on it
+            edge = start_node, end_node, self.graph.new_edge_key(start_node, end_node)
         else:
             edge = start_node, end_node
 
+        # in a simple graph, an existing edge is replaced, so it needs to be recorded for undo before it's deleted
+        removed_edges = []
+        if not self.multi_edge and self.graph.has_edge(start_node, end_node):
+            removed_edges.append(self._edge_record(edge))
+            self._delete_edge(edge)
+
         # widget on edge
         widget = self.WidgetOnEdge(edge, self)
         widget.show()
 
-        self.graph.add_edge(start_node, end_node, widget=widget, color=color)
+        self.graph.add_edge(*edge, widget=widget, color=color)
+
+        self.undo_log.push(GraphChange(added_edges=[self._edge_record(edge)], removed_edges=removed_edges))
 
     def selectEdge(self, edge, multi_select=False):
         if not multi_select:
@@ -551,37 +818,69 @@ class EulerGraphWidget(QtWidgets.QWidget):
         self.update()
 
     def deleteSelection(self):
-        # delete nodes
-        for node in self.selected_nodes:
-            for edge in dict(self.graph.edges):
-                if node == edge[0] or node == edge[1]:
-                    self._delete_edge(edge)
+        nodes = {node for node in self.selected_nodes if node in self.graph}
+
+        # delete the selected edges and the edges attached to the selected nodes
+        edges = list(self.edges(nodes))
+        if self.directed:
+            edges.extend(self.in_edges(nodes))
+        edges.extend(self.selected_edges)
+
+        removed_edges = []
+        edge_orders = {}
+        for edge in edges:
+            if self.graph.has_edge(*edge):
+                # remember the order of parallel edges before any of them are deleted (in an undirected graph, the
+                # edges may be stored either way round, but both orientations share the same keys)
+                pair = edge[0], edge[1]
+                if not self.directed and (edge[1], edge[0]) in edge_orders:
+                    pair = edge[1], edge[0]
+
+                if self.multi_edge and pair not in edge_orders:
+                    edge_orders[pair] = list(self.graph[edge[0]][edge[1]])
+
+                removed_edges.append(self._edge_record(edge))
+                self._delete_edge(edge)
 
-            self.graph.remove_node(node)
+        # delete nodes
+        removed_nodes = []
+        for node in nodes:
+            removed_nodes.append(self._node_record(node))
+            self._delete_node(node)
 
-        # delete edges
-        for edge in self.selected_edges:
-            self._delete_edge(edge)
+        if removed_nodes or removed_edges:
+            self.undo_log.push(GraphChange(removed_nodes=removed_nodes, removed_edges=removed_edges,
+                                           removed_edge_orders=edge_orders.items()))
 
         self.clearSelection()
 
         self.update()
 
     def setNodeColor(self, node, color):
-        self.graph.nodes[node]["color"] = color
-        self.update()
+        self._set_colors("nodes", [node], color)
 
     def setEdgeColor(self, edge, color):
-        self.graph.edges[edge]["color"] = color
-        self.update()
+        self._set_colors("edges", [edge], color)
 
     def setAllEdgeColors(self, color):
-        for edge in self.edges():
-            self.setEdgeColor(edge, color)
+        self._set_colors("edges", self.edges(), color)
 
     def setAllNodeColors(self, color):
-        for node in self.nodes():
-            self.setNodeColor(node, color)
+        self._set_colors("nodes", self.nodes(), color)
+
+    def undo(self):
+        change = self.undo_log.undo()
+        if change is not None:
+            change.undo(self)
+            self._discard_missing_state()
+            self.update()
+
+    def redo(self):
+        change = self.undo_log.redo()
+        if change is not None:
+            change.redo(self)
+            self._discard_missing_state()
+            self.update()
 
     def edges(self, node=None, data=False):
         if self.multi_edge:
@@ -589,6 +888,12 @@ class EulerGraphWidget(QtWidgets.QWidget):
         else:
             return self.graph.edges(node, data=data)
 
+    def in_edges(self, node=None, data=False):
+        if self.multi_edge:
+            return self.graph.in_edges(node, keys=True, data=data)
+        else:
+            return self.graph.in_edges(node, data=data)
+
     def nodes(self, data=False):
         return self.graph.nodes(data=data)
 
@@ -632,6 +937,82 @@ class EulerGraphWidget(QtWidgets.QWidget):
             widget.deleteLater()
             self.graph.remove_edge(*edge)
 
+    def _delete_node(self, node):
+        if node in self.graph:
+            widget = self.graph.nodes[node]["widget"]
+            widget.deleteLater()
+            self.graph.remove_node(node)
+
+    def _node_record(self, node):
+        data = self.graph.nodes[node]
+        return node, {key: value for key, value in data.items() if key != "widget"}
+
+    def _edge_record(self, edge):
+        data = self.graph.edges[edge]
+        attributes = {key: value for key, value in data.items() if key != "widget"}
+        return tuple(edge), attributes, data["widget"].get_text()
+
+    def _restore_node(self, node, attributes):
+        widget = self.WidgetOnNode(self)
+        widget.show()
+
+        # the widget goes after the other attributes, because paintEvent unpacks them in order
+        self.graph.add_node(node, **attributes, widget=widget)
+
+    def _restore_edge(self, edge, attributes, text):
+        widget = self.WidgetOnEdge(edge, self)
+        widget.set_text(text)
+        widget.show()
+
+        self.graph.add_edge(*edge, widget=widget, **attributes)
+
+    def _reorder_parallel_edges(self, start_node, end_node, keys):
+        if not self.graph.has_edge(start_node, end_node):
+            return
+
+        current = list(self.graph[start_node][end_node])
+        order = [key for key in keys if key in current] + [key for key in current if key not in keys]
+        if order == current:
+            return
+
+        # re-add the edges in order, keeping their data (including the widgets)
+        edges = [(key, dict(self.graph.edges[start_node, end_node, key])) for key in order]
+        for key, _ in edges:
+            self.graph.remove_edge(start_node, end_node, key)
+        for key, data in edges:
+            self.graph.add_edge(start_node, end_node, key, **data)
+
+    def _set_colors(self, view, items, color):
+        attributes = getattr(self.graph, view)
+
+        # only record the items that actually change colour
+        changed_items = []
+        old_colors = []
+        for item in items:
+            if attributes[item]["color"] != color:
+                changed_items.append(item)
+                old_colors.append(attributes[item]["color"])
+
+        if changed_items:
+            recolour = Recolour(view, changed_items, old_colors, color)
+            recolour.redo(self)
+            self.undo_log.push(recolour)
+
+        self.update()
+
+    def _discard_missing_state(self):
+        # forget about nodes and edges that were removed by an undo or redo
+        self.selected_nodes = {node for node in self.selected_nodes if node in self.graph}
+        self.selected_edges = {edge for edge in self.selected_edges if self.graph.has_edge(*edge)}
+
+        if self.hovered_node not in self.graph:
+            self.hovered_node = None
+        if self.hovered_edge is not None and not self.graph.has_edge(*self.hovered_edge):
+            self.hovered_edge = None
+        if self.edge_start_node not in self.graph:
+            self.edge_start_node = None
+            self.drawing_edge = False
+
 
 def main():
     class Window(QtWidgets.QMainWindow):